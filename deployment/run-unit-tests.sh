@@ -7,11 +7,18 @@
 # ./run-unit-tests.sh
 #
 
+set -e
+
 # Get reference for all important folders
-# template_dir="$PWD"
-# source_dir="$template_dir/../source"
+template_dir="$PWD"
+source_dir="$template_dir/../source"
 
-# TODO: Temporary till unit tests are added
 echo "------------------------------------------------------------------------------"
-echo "No tests to run"
+echo "Running backend unit tests"
 echo "------------------------------------------------------------------------------"
+cd "$source_dir/backend"
+python3 -m venv /tmp/liveness-test-venv
+. /tmp/liveness-test-venv/bin/activate
+pip install -r requirements.txt pytest
+python -m pytest tests
+deactivate
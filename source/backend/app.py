@@ -7,10 +7,15 @@ from importlib import import_module
 
 from chalice import Chalice
 
-from chalicelib.framework import blueprint, challenge_type_selector
+from chalicelib.framework import blueprint, challenge_type_selector, get_load_metrics
+from chalicelib.load_monitor import choose_challenge_type, publish_decision_metrics
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 CLIENT_CHALLENGE_SELECTION = os.getenv('CLIENT_CHALLENGE_SELECTION', "False").upper() == 'TRUE'
+LOAD_AWARE_CHALLENGE_SELECTION = os.getenv('LOAD_AWARE_CHALLENGE_SELECTION', "False").upper() == 'TRUE'
+MIN_CHALLENGE_TYPE_SHARE = float(os.getenv('MIN_CHALLENGE_TYPE_SHARE', 0.2))
+MAX_IN_FLIGHT_VERIFIES = int(os.getenv('MAX_IN_FLIGHT_VERIFIES', 10))
+LOAD_SHEDDING_FACTOR = float(os.getenv('LOAD_SHEDDING_FACTOR', 2.0))
 
 app = Chalice(app_name='liveness-backend')
 app.log.setLevel(LOG_LEVEL)
@@ -26,4 +31,9 @@ def random_challenge_selector(client_metadata):
     app.log.debug('random_challenge_selector')
     if CLIENT_CHALLENGE_SELECTION and 'challengeType' in client_metadata:
         return client_metadata['challengeType']
+    if LOAD_AWARE_CHALLENGE_SELECTION:
+        challenge_type, decision = choose_challenge_type(['POSE', 'NOSE'], get_load_metrics(), MIN_CHALLENGE_TYPE_SHARE,
+                                                         MAX_IN_FLIGHT_VERIFIES, LOAD_SHEDDING_FACTOR)
+        publish_decision_metrics(decision)
+        return challenge_type
     return secrets.choice(['POSE', 'NOSE'])
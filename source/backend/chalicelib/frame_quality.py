@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import logging
+
+import numpy as np
+from PIL import Image
+
+_DRAFT_SCALE = 8  # JPEG decoding downscale (done on DCT coefficients, so it is cheap)
+_MIN_BRIGHTNESS = 40
+_MAX_BRIGHTNESS = 220
+
+_log = logging.getLogger('liveness-backend')
+
+
+# Cheap quality metrics of a JPEG frame, computed from a downsampled luminance plane
+def get_frame_quality(frame):
+    image = Image.open(io.BytesIO(frame))
+    width, height = image.size
+    image.draft('L', (max(1, width // _DRAFT_SCALE), max(1, height // _DRAFT_SCALE)))
+    luminance = np.asarray(image.convert('L'), dtype=np.float32)
+    _log.debug('luminance plane: %s', luminance.shape)
+    return {
+        'sharpness': round(float(_laplacian(luminance).var()), 2),
+        'brightness': round(float(luminance.mean()), 2),
+        'size': len(frame)
+    }
+
+
+# Sorting key for frames: well exposed frames first, then the sharpest, then the largest
+def get_frame_quality_rank(frame):
+    quality = frame.get('quality')
+    if not quality:
+        return False, 0, 0
+    well_exposed = _MIN_BRIGHTNESS <= quality['brightness'] <= _MAX_BRIGHTNESS
+    return well_exposed, quality['sharpness'], quality['size']
+
+
+def best_frames(frames, count):
+    best = sorted(range(len(frames)), key=lambda index: get_frame_quality_rank(frames[index]), reverse=True)[:count]
+    return [frames[index] for index in sorted(best)]
+
+
+def _laplacian(luminance):
+    if luminance.shape[0] < 3 or luminance.shape[1] < 3:
+        return np.zeros(1, dtype=np.float32)
+    return (4 * luminance[1:-1, 1:-1] -
+            luminance[:-2, 1:-1] - luminance[2:, 1:-1] -
+            luminance[1:-1, :-2] - luminance[1:-1, 2:])
@@ -4,20 +4,23 @@
 import base64
 import binascii
 import imghdr
-import decimal
 import functools
-import json
 import os
 import secrets
+import time
 import uuid
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 from botocore import config
 from botocore.exceptions import ClientError
-from chalice import Blueprint, CognitoUserPoolAuthorizer, BadRequestError, NotFoundError, UnauthorizedError
+from chalice import Blueprint, CognitoUserPoolAuthorizer, BadRequestError, ConflictError, NotFoundError, \
+    UnauthorizedError
 
+from .frame_quality import get_frame_quality
 from .jwt_manager import JwtManager
+from .load_monitor import LoadMonitor
+from .storage import create_storage, STORAGE_DYNAMODB
 
 blueprint = Blueprint(__name__)
 
@@ -26,33 +29,45 @@ STATE_CONTINUE = 0
 CHALLENGE_FAIL = -1
 CHALLENGE_SUCCESS = 2
 
+FRAME_STORE_OBJECT = 'OBJECT'
+FRAME_STORE_PACKED = 'PACKED'
+
 _FAIL_STATE = '_FAIL_STATE'
 _FIRST_STATE = '_FIRST_STATE'
 
 _REGION_NAME = os.getenv('REGION_NAME')
-_BUCKET_NAME = os.getenv('BUCKET_NAME')
-_TABLE_NAME = os.getenv('TABLE_NAME')
+_STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', STORAGE_DYNAMODB)
 _THREAD_POOL_SIZE = int(os.getenv('THREAD_POOL_SIZE', 10))
+_VERIFY_LOCK_TIMEOUT = int(os.getenv('VERIFY_LOCK_TIMEOUT', 180))  # must exceed the Lambda timeout (120s)
+_VERIFY_WAIT_TIMEOUT = float(os.getenv('VERIFY_WAIT_TIMEOUT', 5))
+_VERIFY_WAIT_INTERVAL = float(os.getenv('VERIFY_WAIT_INTERVAL', 1))
+_LOAD_MONITORING = os.getenv('LOAD_AWARE_CHALLENGE_SELECTION', 'False').upper() == 'TRUE'
+_STATELESS_CHALLENGES = os.getenv('STATELESS_CHALLENGES', 'False').upper() == 'TRUE'
+_CHALLENGE_MAX_AGE = int(os.getenv('CHALLENGE_MAX_AGE', 600))
+_FRAME_STORE_MODE = os.getenv('FRAME_STORE_MODE', FRAME_STORE_OBJECT).upper()
 _SEND_ANONYMOUS_USAGE_DATA = os.getenv('SEND_ANONYMOUS_USAGE_DATA', 'False').upper() == 'TRUE'
 
 _MAX_IMAGE_SIZE = 15728640
+_MAX_INLINE_IMAGE_SIZE = 5242880  # Rekognition limit for images passed as bytes
+_THROTTLING_ERRORS = ['ThrottlingException', 'ProvisionedThroughputExceededException']
 
 _extra_params = {}
 if _SEND_ANONYMOUS_USAGE_DATA and 'SOLUTION_IDENTIFIER' in os.environ:
     _extra_params['user_agent_extra'] = os.environ['SOLUTION_IDENTIFIER']
 config = config.Config(**_extra_params)
 
-_s3 = boto3.client('s3', region_name=_REGION_NAME, config=config)
 _rek = boto3.client('rekognition', region_name=_REGION_NAME, config=config)
-_table = boto3.resource('dynamodb', region_name=_REGION_NAME, config=config).Table(_TABLE_NAME) if _TABLE_NAME else None
+_challenge_store, _frame_store, _load_store = create_storage(_STORAGE_BACKEND, _REGION_NAME, config)
 
 _challenge_types = []
 _challenge_params_funcs = dict()
 _challenge_state_funcs = dict()
+_challenge_frame_selector_funcs = dict()
 
 _challenge_type_selector_func = [lambda client_metadata: secrets.choice(_challenge_types)]
 
-_jwt_manager = JwtManager(os.getenv('TOKEN_SECRET'))
+_jwt_manager = JwtManager(os.getenv('TOKEN_SECRET'), _CHALLENGE_MAX_AGE)
+_load_monitor = LoadMonitor(_load_store) if _LOAD_MONITORING else None
 
 
 authorizer = CognitoUserPoolAuthorizer('LivenessUserPool', provider_arns=[os.getenv('COGNITO_USER_POOL_ARN',
@@ -75,6 +90,21 @@ def challenge_params(challenge_type):
     return decorator
 
 
+def get_load_metrics():
+    # Returns None when load monitoring is disabled
+    return _load_monitor.get_metrics() if _load_monitor else None
+
+
+def challenge_frame_selector(challenge_type):
+    def decorator(func):
+        if challenge_type not in _challenge_types:
+            _challenge_types.append(challenge_type)
+        _challenge_frame_selector_funcs[challenge_type] = func
+        return func
+
+    return decorator
+
+
 def check_state_timeout(func, end_times, frame, timeout):
     frame_timestamp = frame['timestamp']
     if func.__name__ not in end_times:
@@ -142,16 +172,19 @@ def jwt_token_auth(func):
             request = blueprint.current_request.json_body
             token = request['token']
             blueprint.log.debug(f'Authorization header (JWT): {token}')
-            jwt_challenge_id = _jwt_manager.get_challenge_id(token)
-            blueprint.log.debug(f'Authorization header challenge id: {jwt_challenge_id}')
+            token_challenge = _jwt_manager.get_challenge(token)
+            blueprint.log.debug(f'Authorization header challenge id: {token_challenge["id"]}')
             blueprint.log.debug(f'Request challenge id: {challenge_id}')
-            if challenge_id != jwt_challenge_id:
+            if challenge_id != token_challenge['id']:
+                raise AssertionError()
+            # In stateless mode, tokens must carry the challenge (and so expire)
+            if _STATELESS_CHALLENGES and 'type' not in token_challenge:
                 raise AssertionError()
         except Exception:
             blueprint.log.debug('Could not verify challenge id')
             raise UnauthorizedError()
         blueprint.log.debug('Challenge id successfully verified')
-        return func(challenge_id)
+        return func(challenge_id, token_challenge)
 
     return inner
 
@@ -172,92 +205,150 @@ def create_challenge():
     except ValueError:
         raise BadRequestError('Invalid imageHeight')
     blueprint.log.debug('client_metadata: %s', client_metadata)
-    # Saving challenge on DynamoDB table
     challenge = dict()
     challenge_id = str(uuid.uuid1())
     challenge['id'] = challenge_id
-    challenge['token'] = _jwt_manager.get_jwt_token(challenge_id)
     challenge['type'] = _challenge_type_selector_func[0](client_metadata)
     challenge['params'] = _challenge_params_funcs[challenge['type']](client_metadata)
+    if _STATELESS_CHALLENGES:
+        # Challenge type and params are signed into the token instead of being saved
+        challenge['token'] = _jwt_manager.get_jwt_token(challenge_id, challenge['type'], challenge['params'])
+        blueprint.log.debug('challenge: %s', challenge)
+        return challenge
+    # Saving challenge on challenge store
+    challenge['token'] = _jwt_manager.get_jwt_token(challenge_id)
     blueprint.log.debug('challenge: %s', challenge)
-    _table.put_item(Item=challenge)
+    _challenge_store.put_challenge(challenge)
     return challenge
 
 
 @blueprint.route('/challenge/{challenge_id}/frame', methods=['PUT'], cors=True, authorizer=authorizer)
 @jwt_token_auth
-def put_challenge_frame(challenge_id):
+def put_challenge_frame(challenge_id, _token_challenge):
     blueprint.log.debug('put_challenge_frame: %s', challenge_id)
     request = blueprint.current_request.json_body
+    # Frames can be sent one per request or in batches (stored in a single pack when packed frame store is enabled)
+    request_frames = request['frames'] if 'frames' in request else [request]
+    if not request_frames:
+        raise BadRequestError('Missing frames')
+    frames = [_read_request_frame(request_frame) for request_frame in request_frames]
+    frame_items = []
+    for timestamp, frame in frames:
+        frame_key = '{}/{}.jpg'.format(challenge_id, timestamp)
+        blueprint.log.debug('frame_key: %s', frame_key)
+        frame_item = {
+            'timestamp': timestamp,
+            'key': frame_key
+        }
+        # Scoring frame quality (used to select the frames sent to Rekognition)
+        try:
+            frame_item['quality'] = get_frame_quality(frame)
+        except Exception as e:
+            blueprint.log.info('Could not compute frame quality: %s', e)
+        frame_items.append(frame_item)
+    pack = None
+    if _FRAME_STORE_MODE == FRAME_STORE_PACKED:
+        pack = _build_frame_pack(challenge_id, frames, frame_items)
+    blueprint.log.debug('frame_items: %s', frame_items)
+    # Updating challenge on challenge store
+    if not _challenge_store.append_frames(challenge_id, frame_items, create=_STATELESS_CHALLENGES):
+        blueprint.log.info('Challenge not found: %s', challenge_id)
+        raise NotFoundError('Challenge not found')
+    # Uploading frames (or frame pack) to frame store
+    if pack is not None:
+        _frame_store.put_frame(pack[0], pack[1])
+    else:
+        for frame_item, (_, frame) in zip(frame_items, frames):
+            _frame_store.put_frame(frame_item['key'], frame)
+    return {'message': 'Frame saved successfully'}
+
+
+def get_challenge_frame(frame):
+    # Resolves a frame of a challenge record (stored as a single object or inside a frame pack)
+    # In packed mode, the frame key only identifies the frame: the frame is read from its pack
+    if 'pack' in frame:
+        pack = frame['pack']
+        return _frame_store.get_frame(pack['key'], pack['offset'], pack['length'])
+    return _frame_store.get_frame(frame['key'])
+
+
+def _read_request_frame(request_frame):
     # Validating timestamp input
     try:
-        timestamp = int(request['timestamp'])
-    except ValueError:
+        timestamp = int(request_frame['timestamp'])
+    except (KeyError, ValueError):
         raise BadRequestError('Invalid timestamp')
     blueprint.log.debug('timestamp: %s', timestamp)
     # Validating frame input
     try:
-        frame = base64.b64decode(request['frameBase64'], validate=True)
-    except binascii.Error:
+        frame = base64.b64decode(request_frame['frameBase64'], validate=True)
+    except (KeyError, binascii.Error):
         raise BadRequestError('Invalid Image')
-    if len(frame) > _MAX_IMAGE_SIZE:
+    # Frames passed to Rekognition as bytes (packed or not stored on S3) have a lower size limit
+    inline_image = _FRAME_STORE_MODE == FRAME_STORE_PACKED or _frame_store.inline_detection_image
+    max_image_size = _MAX_INLINE_IMAGE_SIZE if inline_image else _MAX_IMAGE_SIZE
+    if len(frame) > max_image_size:
         raise BadRequestError('Image size too large')
     if imghdr.what(None, h=frame) != 'jpeg':
         raise BadRequestError('Image must be JPEG')
-    frame_key = '{}/{}.jpg'.format(challenge_id, timestamp)
-    blueprint.log.debug('frame_key: %s', frame_key)
-    # Updating challenge on DynamoDB table
-    try:
-        _table.update_item(
-            Key={'id': challenge_id},
-            UpdateExpression='set #frames = list_append(if_not_exists(#frames, :empty_list), :frame)',
-            ExpressionAttributeNames={'#frames': 'frames'},
-            ExpressionAttributeValues={
-                ':empty_list': [],
-                ':frame': [{
-                    'timestamp': timestamp,
-                    'key': frame_key
-                }]
-            },
-            ReturnValues='NONE'
-        )
-    except ClientError as error:
-        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            blueprint.log.info('Challenge not found: %s', challenge_id)
-            raise NotFoundError('Challenge not found')
-    # Uploading frame to S3 bucket
-    _s3.put_object(
-        Body=frame,
-        Bucket=_BUCKET_NAME,
-        Key=frame_key,
-        ExpectedBucketOwner=os.getenv('ACCOUNT_ID')  # Bucket Sniping prevention
-    )
-    return {'message': 'Frame saved successfully'}
+    return timestamp, frame
+
+
+def _build_frame_pack(challenge_id, frames, frame_items):
+    # Concatenates frames into a single object, recording each frame offset on its frame item
+    # Unique suffix, so a later batch starting at the same timestamp does not overwrite this pack
+    pack_key = '{}/{}-{}.pack'.format(challenge_id, frames[0][0], uuid.uuid4())
+    blueprint.log.debug('pack_key: %s', pack_key)
+    offset = 0
+    for frame_item, (_, frame) in zip(frame_items, frames):
+        frame_item['pack'] = {
+            'key': pack_key,
+            'offset': offset,
+            'length': len(frame)
+        }
+        offset += len(frame)
+    return pack_key, b''.join(frame for _, frame in frames)
 
 
 @blueprint.route('/challenge/{challenge_id}/verify', methods=['POST'], cors=True, authorizer=authorizer)
 @jwt_token_auth
-def verify_challenge_response(challenge_id):
+def verify_challenge_response(challenge_id, token_challenge):
     blueprint.log.debug('verify_challenge_response: %s', challenge_id)
-    # Looking up challenge on DynamoDB table
-    item = _table.get_item(Key={'id': challenge_id})
-    if 'Item' not in item:
-        blueprint.log.info('Challenge not found: %s', challenge_id)
-        raise NotFoundError('Challenge not found')
-    challenge = _read_item(item['Item'])
+    # Acquiring verify lock (or returning the stored result, or waiting for the result of a concurrent verify)
+    lock, challenge = _acquire_verify_lock(challenge_id)
+    if lock is None:
+        return _wait_verify_result(challenge_id)
     blueprint.log.debug('challenge: %s', challenge)
-    # Getting challenge type, params and frames
+    audit = dict()
+    if _STATELESS_CHALLENGES:
+        # Challenge type and params come from the token (expired tokens are rejected by jwt_token_auth)
+        # Saving them along with the result (for audit)
+        blueprint.log.debug('token_challenge: %s', token_challenge)
+        audit = {key: token_challenge[key] for key in ('type', 'params', 'issuedAt')}
+        challenge.update(audit)
+    # Recording verify cost (used by load-aware challenge type selection)
+    load_stats = {'detections': 0, 'throttled': 0}
+    start_time = time.time()
+    if _load_monitor:
+        _load_monitor.verify_started()
+    try:
+        return _verify_challenge(challenge_id, challenge, lock, audit, load_stats)
+    except Exception:
+        # Releasing verify lock on any failure, so a retry does not wait for the lock to expire
+        _release_verify_lock(challenge_id, lock)
+        raise
+    finally:
+        if _load_monitor:
+            _load_monitor.verify_finished(challenge.get('type'), time.time() - start_time,
+                                          load_stats['detections'], load_stats['throttled'])
+
+
+def _verify_challenge(challenge_id, challenge, lock, audit, load_stats):
     challenge_type = challenge['type']
     params = challenge['params']
-    frames = challenge['frames']
-    # Invoking Rekognition with parallel threads
-    with ThreadPoolExecutor(max_workers=_THREAD_POOL_SIZE) as pool:
-        futures = [
-            pool.submit(
-                _detect_faces, frame
-            ) for frame in frames
-        ]
-        frames = [r.result() for r in as_completed(futures)]
+    frames = challenge.get('frames', [])
+    selected_frames = _select_frames(challenge_type, frames)
+    frames = _analyze_frames(challenge_id, frames, selected_frames, load_stats)
     frames.sort(key=lambda frame: frame['key'])
     current_state = _challenge_state_funcs[challenge_type][_FIRST_STATE]
     context = dict()
@@ -287,49 +378,126 @@ def verify_challenge_response(challenge_id):
     blueprint.log.debug('success: %s', success)
     response = {'success': success}
     blueprint.log.debug('response: %s', response)
-    # Updating challenge on DynamoDB table
-    _table.update_item(
-        Key={'id': challenge_id},
-        UpdateExpression='set #frames = :frames, #success = :success',
-        ExpressionAttributeNames={
-            '#frames': 'frames',
-            '#success': 'success'
-        },
-        ExpressionAttributeValues={
-            ':frames': _write_item(frames),
-            ':success': response['success']
-        },
-        ReturnValues='NONE'
-    )
+    # Updating challenge on challenge store (and releasing verify lock)
+    if not _challenge_store.save_result(challenge_id, response['success'], lock, audit):
+        blueprint.log.info('Verify lock lost, result not saved: %s', challenge_id)
     return response
 
 
-def _detect_faces(frame):
-    frame['rekMetadata'] = _rek.detect_faces(
-        Attributes=['ALL'],
-        Image={
-            'S3Object': {
-                'Bucket': _BUCKET_NAME,
-                'Name': frame['key']
-            }
-        }
-    )['FaceDetails']
-    return frame
-
-
-def _read_item(item):
-    return json.loads(json.dumps(item, cls=_DecimalEncoder))
+def _get_challenge(challenge_id):
+    # Looking up challenge on challenge store
+    challenge = _challenge_store.get_challenge(challenge_id)
+    if challenge is None:
+        blueprint.log.info('Challenge not found: %s', challenge_id)
+        raise NotFoundError('Challenge not found')
+    return challenge
 
 
-def _write_item(item):
-    return json.loads(json.dumps(item), parse_float=decimal.Decimal)
+def _acquire_verify_lock(challenge_id):
+    # Returns the locked challenge, so frames analyzed by a previous attempt are picked up without another read
+    now = int(time.time())
+    lock = now + _VERIFY_LOCK_TIMEOUT
+    challenge = _challenge_store.acquire_verify_lock(challenge_id, lock, now)
+    if challenge is None:
+        blueprint.log.info('Verify lock not acquired: %s', challenge_id)
+        return None, None
+    blueprint.log.debug('Verify lock acquired: %s', challenge_id)
+    return lock, challenge
 
 
-# Helper class to convert a DynamoDB item to JSON.
-class _DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            return int(o)
-        return super(_DecimalEncoder, self).default(o)
+def _release_verify_lock(challenge_id, lock):
+    try:
+        _challenge_store.release_verify_lock(challenge_id, lock)
+    except Exception as e:
+        blueprint.log.info('Could not release verify lock: %s', e)
+
+
+def _wait_verify_result(challenge_id):
+    # Lock not acquired: challenge missing (404), already verified (stored result) or locked by a concurrent verify
+    # Waiting briefly (well below the 29s API Gateway timeout), then asking the client to retry
+    deadline = time.time() + _VERIFY_WAIT_TIMEOUT
+    while time.time() < deadline:
+        challenge = _get_challenge(challenge_id)
+        if 'success' in challenge:
+            blueprint.log.info('Challenge already verified: %s', challenge_id)
+            return {'success': challenge['success']}
+        if 'verifyLock' not in challenge or challenge['verifyLock'] < time.time():
+            break
+        time.sleep(_VERIFY_WAIT_INTERVAL)
+    blueprint.log.info('Verify still in progress: %s', challenge_id)
+    raise ConflictError('Challenge verification in progress')
+
+
+def _select_frames(challenge_type, frames):
+    if challenge_type not in _challenge_frame_selector_funcs:
+        return frames
+    selected_frames = _challenge_frame_selector_funcs[challenge_type](frames)
+    blueprint.log.debug('selected frames: %s of %s', len(selected_frames), len(frames))
+    return selected_frames
+
+
+def _analyze_frames(challenge_id, frames, selected_frames, load_stats):
+    # Invoking Rekognition with parallel threads (only for selected frames not analyzed yet)
+    # Selected frames are matched by key, so selectors may return copies of the stored frames
+    selected_keys = {frame['key'] for frame in selected_frames}
+    selected = {index: frame for index, frame in enumerate(frames) if frame['key'] in selected_keys}
+    analyzed = [frame for frame in selected.values() if 'rekMetadata' in frame]
+    pending = {index: frame for index, frame in selected.items() if 'rekMetadata' not in frame}
+    blueprint.log.debug('analyzed frames: %s pending frames: %s', len(analyzed), len(pending))
+    if not pending:
+        return analyzed
+    load_stats['detections'] += len(pending)
+    errors = []
+    with ThreadPoolExecutor(max_workers=_THREAD_POOL_SIZE) as pool:
+        images = _load_packed_frames(pool, pending)
+        futures = [
+            pool.submit(
+                _detect_faces, frame, images.get(index)
+            ) for index, frame in pending.items()
+        ]
+        for future in as_completed(futures):
+            try:
+                analyzed.append(future.result())
+            except Exception as e:
+                blueprint.log.error('Exception: %s', e)
+                if isinstance(e, ClientError) and e.response['Error']['Code'] in _THROTTLING_ERRORS:
+                    load_stats['throttled'] += 1
+                errors.append(e)
+    # Saving metadata so that a retry does not analyze the same frames again
+    _challenge_store.save_frames_metadata(challenge_id, pending)
+    if errors:
+        raise errors[0]
+    return analyzed
+
+
+def _load_packed_frames(pool, frames):
+    # Reading each frame pack once (a single ranged GET covering its selected frames), returns images by frame index
+    packs = dict()
+    for index, frame in frames.items():
+        if 'pack' in frame:
+            packs.setdefault(frame['pack']['key'], []).append(index)
+    images = dict()
+    pack_frames = [[frames[index] for index in indexes] for indexes in packs.values()]
+    for indexes, pack in zip(packs.values(), pool.map(_read_frame_pack, pack_frames)):
+        images.update(zip(indexes, pack))
+    return images
+
+
+def _read_frame_pack(frames):
+    start = min(frame['pack']['offset'] for frame in frames)
+    end = max(frame['pack']['offset'] + frame['pack']['length'] for frame in frames)
+    data = _frame_store.get_frame(frames[0]['pack']['key'], start, end - start)
+    return [data[frame['pack']['offset'] - start:frame['pack']['offset'] - start + frame['pack']['length']]
+            for frame in frames]
+
+
+def _detect_faces(frame, image=None):
+    if image is not None:
+        image = {'Bytes': image}
+    else:
+        image = _frame_store.get_detection_image(frame['key'])
+    frame['rekMetadata'] = _rek.detect_faces(
+        Attributes=['ALL'],
+        Image=image
+    )['FaceDetails']
+    return frame
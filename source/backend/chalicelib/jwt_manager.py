@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import time
+
 import jwt
 
 from aws_lambda_powertools.utilities import parameters
@@ -9,15 +11,32 @@ from aws_lambda_powertools.utilities import parameters
 class JwtManager:
     JWT_ALGORITHM = 'HS256'
 
-    def __init__(self, token_secret):
+    def __init__(self, token_secret, challenge_max_age=None):
         self.secret = parameters.get_secret(token_secret) if token_secret else None
+        self.challenge_max_age = challenge_max_age
 
-    def get_jwt_token(self, challenge_id):
+    def get_jwt_token(self, challenge_id, challenge_type=None, challenge_params=None):
         payload = {
             'challengeId': challenge_id
         }
+        if challenge_type is not None:
+            # Tokens carrying the challenge expire, so they cannot be used after the challenge max age
+            now = int(time.time())
+            payload['challengeType'] = challenge_type
+            payload['challengeParams'] = challenge_params
+            payload['iat'] = now
+            payload['exp'] = now + self.challenge_max_age
         return jwt.encode(payload, self.secret, algorithm=JwtManager.JWT_ALGORITHM)
 
-    def get_challenge_id(self, jwt_token):
+    def get_challenge(self, jwt_token):
+        # Challenge id, plus type, params and issue time when they are signed into the token
+        # Raises jwt.ExpiredSignatureError if the token has expired
         decoded = jwt.decode(jwt_token, self.secret, algorithms=JwtManager.JWT_ALGORITHM)
-        return decoded['challengeId']
+        challenge = {
+            'id': decoded['challengeId']
+        }
+        if 'challengeType' in decoded:
+            challenge['type'] = decoded['challengeType']
+            challenge['params'] = decoded['challengeParams']
+            challenge['issuedAt'] = decoded['iat']
+        return challenge
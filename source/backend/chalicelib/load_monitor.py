@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import os
+import secrets
+import threading
+import time
+
+from aws_lambda_powertools.metrics import MetricUnit, single_metric
+
+_BUCKET_SECONDS = 10
+_WINDOW_BUCKETS = 30  # longer than a verify (Lambda timeout), so started and finished verifies cancel out
+_HALF_LIFE_SECONDS = 60  # weight of the counters halves every minute
+_CACHE_SECONDS = 5
+_METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'LivenessDetection')
+
+_log = logging.getLogger('liveness-backend')
+
+
+# Backend load shared by all backend instances (through a load store): cost of each challenge type and current pressure
+class LoadMonitor:
+
+    def __init__(self, load_store, bucket_seconds=_BUCKET_SECONDS, window_buckets=_WINDOW_BUCKETS,
+                 half_life_seconds=_HALF_LIFE_SECONDS, cache_seconds=_CACHE_SECONDS):
+        self.load_store = load_store
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        self.half_life_seconds = half_life_seconds
+        self.cache_seconds = cache_seconds
+        self.lock = threading.Lock()
+        self.cache = None
+        self.cache_time = 0
+
+    def verify_started(self):
+        self._add_counters({'started': 1})
+
+    def verify_finished(self, challenge_type, latency, detections, throttled):
+        counters = {
+            'finished': 1,
+            'detections': detections,
+            'throttled': throttled
+        }
+        if challenge_type is not None:
+            counters['{}:verifies'.format(challenge_type)] = 1
+            counters['{}:detections'.format(challenge_type)] = detections
+            counters['{}:latencyMs'.format(challenge_type)] = int(latency * 1000)
+        self._add_counters(counters)
+
+    def get_metrics(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.cache is not None and now - self.cache_time < self.cache_seconds:
+                return self.cache
+        current_bucket = self._get_bucket(now)
+        buckets = [current_bucket - index * self.bucket_seconds for index in range(self.window_buckets)]
+        try:
+            counters = self.load_store.get_counters(buckets)
+        except Exception as e:
+            _log.error('Could not read load counters: %s', e)
+            counters = dict()
+        metrics = self._compute_metrics(counters, now)
+        with self.lock:
+            self.cache = metrics
+            self.cache_time = now
+        return metrics
+
+    def _compute_metrics(self, counters, now):
+        in_flight_verifies = 0
+        detections = 0
+        totals = dict()
+        for bucket, bucket_counters in counters.items():
+            in_flight_verifies += bucket_counters.get('started', 0) - bucket_counters.get('finished', 0)
+            detections += bucket_counters.get('detections', 0)
+            # Time-based decay: recent buckets weigh more, and pressure fades when no verify runs
+            age = max(0, now - (bucket + self.bucket_seconds / 2))
+            weight = 0.5 ** (age / self.half_life_seconds)
+            for name, value in bucket_counters.items():
+                totals[name] = totals.get(name, 0) + weight * value
+        challenge_types = dict()
+        for name in totals:
+            if name.endswith(':verifies') and totals[name] > 0:
+                challenge_type = name[:-len(':verifies')]
+                verifies = totals[name]
+                challenge_types[challenge_type] = {
+                    'verifies': verifies,
+                    'detections': totals.get('{}:detections'.format(challenge_type), 0) / verifies,
+                    'latency': totals.get('{}:latencyMs'.format(challenge_type), 0) / verifies / 1000
+                }
+        # Decayed throttles over all detections of the window, so the rate fades when throttling stops
+        return {
+            'inFlightVerifies': max(0, in_flight_verifies),
+            'throttleRate': totals.get('throttled', 0) / detections if detections > 0 else 0.0,
+            'challengeTypes': challenge_types
+        }
+
+    def _add_counters(self, counters):
+        now = time.time()
+        bucket = self._get_bucket(now)
+        expires_at = bucket + (self.window_buckets + 1) * self.bucket_seconds
+        # Load counters are best effort, they must not fail the request
+        try:
+            self.load_store.add_counters(bucket, counters, expires_at)
+        except Exception as e:
+            _log.error('Could not save load counters: %s', e)
+
+    def _get_bucket(self, now):
+        return int(now // self.bucket_seconds * self.bucket_seconds)
+
+
+def choose_challenge_type(challenge_types, metrics, min_share, max_in_flight_verifies, shedding_factor):
+    pressure = min(1.0, max(metrics['inFlightVerifies'] / max_in_flight_verifies, metrics['throttleRate']))
+    costs = _get_relative_costs(challenge_types, metrics['challengeTypes'])
+    # No pressure keeps a uniform mix; under pressure, cheaper challenge types get proportionally more weight
+    weights = [cost ** (-shedding_factor * pressure) for cost in costs]
+    min_share = min(min_share, 1 / len(challenge_types))
+    shares = [min_share + (1 - min_share * len(challenge_types)) * weight / sum(weights) for weight in weights]
+    challenge_type = secrets.SystemRandom().choices(challenge_types, weights=shares)[0]
+    decision = {
+        'challengeType': challenge_type,
+        'pressure': round(pressure, 3),
+        'shares': {t: round(share, 3) for t, share in zip(challenge_types, shares)},
+        'costs': {t: round(cost, 3) for t, cost in zip(challenge_types, costs)},
+        'metrics': metrics
+    }
+    _log.debug('Challenge type selection: %s', decision)
+    return challenge_type, decision
+
+
+def publish_decision_metrics(decision):
+    # Publishes the decision as CloudWatch metrics (using the embedded metric format on the Lambda logs)
+    metrics = decision['metrics']
+    _publish_metric('LoadPressure', MetricUnit.Percent, 100 * decision['pressure'])
+    _publish_metric('InFlightVerifies', MetricUnit.Count, metrics['inFlightVerifies'])
+    _publish_metric('ThrottleRate', MetricUnit.Percent, 100 * metrics['throttleRate'])
+    for challenge_type, share in decision['shares'].items():
+        _publish_metric('ChallengeTypeShare', MetricUnit.Percent, 100 * share, challenge_type)
+        _publish_metric('ChallengeTypeCost', MetricUnit.Count, decision['costs'][challenge_type], challenge_type)
+    _publish_metric('ChallengeTypeSelected', MetricUnit.Count, 1, decision['challengeType'])
+
+
+def _publish_metric(name, unit, value, challenge_type=None):
+    with single_metric(name=name, unit=unit, value=value, namespace=_METRICS_NAMESPACE) as metric:
+        if challenge_type is not None:
+            metric.add_dimension(name='ChallengeType', value=challenge_type)
+
+
+def _get_relative_costs(challenge_types, type_metrics):
+    # Cost relative to the mean of the observed challenge types (1 when not observed yet)
+    observed = [type_metrics[t] for t in challenge_types if t in type_metrics]
+    if not observed:
+        return [1.0] * len(challenge_types)
+    mean_detections = sum(metrics['detections'] for metrics in observed) / len(observed) or 1
+    mean_latency = sum(metrics['latency'] for metrics in observed) / len(observed) or 1
+    costs = []
+    for challenge_type in challenge_types:
+        if challenge_type not in type_metrics:
+            costs.append(1.0)
+            continue
+        metrics = type_metrics[challenge_type]
+        cost = (metrics['detections'] / mean_detections + metrics['latency'] / mean_latency) / 2
+        costs.append(max(cost, 0.01))
+    return costs
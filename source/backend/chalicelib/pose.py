@@ -4,7 +4,8 @@
 import logging
 import secrets
 
-from .framework import challenge_params, challenge_state
+from .frame_quality import best_frames
+from .framework import challenge_frame_selector, challenge_params, challenge_state
 from .framework import CHALLENGE_SUCCESS, CHALLENGE_FAIL
 
 _log = logging.getLogger('liveness-backend')
@@ -15,6 +16,7 @@ POSE_MOUTH = ['CLOSED', 'SMILE']
 REKOGNITION_FACE_MIN_CONFIDENCE = 90
 REKOGNITION_FACE_MAX_ROTATION = 20
 EYE_DIRECTION_AREA_MULTIPLIER = 1.2  # the bigger the value, more permissive
+SELECTED_FRAMES = 1  # the challenge is decided on the first frame, so only the best one is analyzed
 
 
 @challenge_params(challenge_type='POSE')
@@ -31,6 +33,11 @@ def pose_challenge_params(client_metadata):
     return params
 
 
+@challenge_frame_selector(challenge_type='POSE')
+def pose_frame_selector(frames):
+    return best_frames(frames, SELECTED_FRAMES)
+
+
 @challenge_state(challenge_type='POSE', first=True)
 def first_state(params, frame, _context):
     _log.debug(f'Params: {params}')
@@ -0,0 +1,545 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import copy
+import decimal
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import closing
+
+import boto3
+from botocore.exceptions import ClientError
+
+STORAGE_DYNAMODB = 'DYNAMODB'
+STORAGE_MEMORY = 'MEMORY'
+STORAGE_SQLITE = 'SQLITE'
+
+_MAX_UPDATE_EXPRESSION_LENGTH = 4000  # DynamoDB limit is 4 KB
+
+
+def create_storage(backend, region_name=None, config=None):
+    # Returns the (challenge store, frame store, load store) of a storage backend
+    backend = backend.upper()
+    if backend == STORAGE_DYNAMODB:
+        return (DynamoDbChallengeStore(os.getenv('TABLE_NAME'), region_name, config),
+                S3FrameStore(os.getenv('BUCKET_NAME'), os.getenv('ACCOUNT_ID'), region_name, config),
+                DynamoDbLoadStore(os.getenv('LOAD_TABLE_NAME'), region_name, config))
+    if backend == STORAGE_MEMORY:
+        return MemoryChallengeStore(), MemoryFrameStore(), MemoryLoadStore()
+    if backend == STORAGE_SQLITE:
+        database = os.getenv('SQLITE_DATABASE', '/tmp/liveness.db')
+        return (SqliteChallengeStore(database),
+                FileSystemFrameStore(os.getenv('FRAME_DIRECTORY', '/tmp/liveness-frames')),
+                SqliteLoadStore(database))
+    raise ValueError('Invalid storage backend: {}'.format(backend))
+
+
+class ChallengeStore(ABC):
+
+    @abstractmethod
+    def put_challenge(self, challenge):
+        pass
+
+    @abstractmethod
+    def get_challenge(self, challenge_id):
+        # Returns None if the challenge does not exist
+        pass
+
+    @abstractmethod
+    def append_frames(self, challenge_id, frames, create=False):
+        # Returns False if the challenge does not exist (and create is False)
+        pass
+
+    @abstractmethod
+    def acquire_verify_lock(self, challenge_id, lock, now):
+        # Returns the locked challenge, or None if it is verified or locked (lock not expired) by another request
+        pass
+
+    @abstractmethod
+    def release_verify_lock(self, challenge_id, lock):
+        pass
+
+    @abstractmethod
+    def save_frames_metadata(self, challenge_id, frames):
+        # Frames are given by index, so frames appended in the meantime are preserved
+        pass
+
+    @abstractmethod
+    def save_result(self, challenge_id, success, lock, attributes=None):
+        # Returns False if the verify lock was lost (result not saved)
+        pass
+
+
+class FrameStore(ABC):
+    # Whether frames are passed to Rekognition as bytes (limited to 5 MB) instead of as S3 objects
+    inline_detection_image = True
+
+    @abstractmethod
+    def put_frame(self, key, body):
+        pass
+
+    @abstractmethod
+    def get_frame(self, key, offset=None, length=None):
+        pass
+
+    def get_detection_image(self, key):
+        # Image parameter for Rekognition
+        return {'Bytes': self.get_frame(key)}
+
+
+# Load counters shared by all backend instances, grouped in time buckets
+class LoadStore(ABC):
+
+    @abstractmethod
+    def add_counters(self, bucket, counters, expires_at):
+        # Atomically adds the counters to the bucket (kept until expires_at)
+        pass
+
+    @abstractmethod
+    def get_counters(self, buckets):
+        # Returns the counters of each existing bucket
+        pass
+
+
+class DynamoDbChallengeStore(ChallengeStore):
+
+    def __init__(self, table_name, region_name=None, config=None):
+        self.table = boto3.resource('dynamodb', region_name=region_name, config=config).Table(
+            table_name) if table_name else None
+
+    def put_challenge(self, challenge):
+        self.table.put_item(Item=_write_item(challenge))
+
+    def get_challenge(self, challenge_id):
+        item = self.table.get_item(Key={'id': challenge_id}, ConsistentRead=True)
+        if 'Item' not in item:
+            return None
+        return _read_item(item['Item'])
+
+    def append_frames(self, challenge_id, frames, create=False):
+        params = dict()
+        expression_attribute_names = {'#frames': 'frames'}
+        if not create:
+            params['ConditionExpression'] = 'attribute_exists(#id)'
+            expression_attribute_names['#id'] = 'id'
+        try:
+            self.table.update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set #frames = list_append(if_not_exists(#frames, :empty_list), :frame)',
+                ExpressionAttributeNames=expression_attribute_names,
+                ExpressionAttributeValues={
+                    ':empty_list': [],
+                    ':frame': _write_item(frames)
+                },
+                ReturnValues='NONE',
+                **params
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise error
+        return True
+
+    def acquire_verify_lock(self, challenge_id, lock, now):
+        try:
+            item = self.table.update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set #lock = :lock',
+                ConditionExpression='attribute_exists(#id) and attribute_not_exists(#success) and '
+                                    '(attribute_not_exists(#lock) or #lock < :now)',
+                ExpressionAttributeNames={
+                    '#id': 'id',
+                    '#success': 'success',
+                    '#lock': 'verifyLock'
+                },
+                ExpressionAttributeValues={
+                    ':lock': lock,
+                    ':now': now
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise error
+        return _read_item(item['Attributes'])
+
+    def release_verify_lock(self, challenge_id, lock):
+        try:
+            self.table.update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='remove #lock',
+                ConditionExpression='#lock = :lock',
+                ExpressionAttributeNames={'#lock': 'verifyLock'},
+                ExpressionAttributeValues={':lock': lock},
+                ReturnValues='NONE'
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise error
+
+    def save_frames_metadata(self, challenge_id, frames):
+        # Split into several updates, so each update expression stays under the DynamoDB limit
+        update_expression = []
+        expression_attribute_values = dict()
+        for index, frame in frames.items():
+            if 'rekMetadata' not in frame:
+                continue
+            clause = '#frames[{0}].#rekMetadata = :rekMetadata{0}'.format(index)
+            if update_expression and len('set ' + ', '.join(update_expression + [clause])) > \
+                    _MAX_UPDATE_EXPRESSION_LENGTH:
+                self._save_frames_metadata(challenge_id, update_expression, expression_attribute_values)
+                update_expression = []
+                expression_attribute_values = dict()
+            update_expression.append(clause)
+            expression_attribute_values[':rekMetadata{}'.format(index)] = _write_item(frame['rekMetadata'])
+        if update_expression:
+            self._save_frames_metadata(challenge_id, update_expression, expression_attribute_values)
+
+    def _save_frames_metadata(self, challenge_id, update_expression, expression_attribute_values):
+        self.table.update_item(
+            Key={'id': challenge_id},
+            UpdateExpression='set ' + ', '.join(update_expression),
+            ExpressionAttributeNames={
+                '#frames': 'frames',
+                '#rekMetadata': 'rekMetadata'
+            },
+            ExpressionAttributeValues=expression_attribute_values,
+            ReturnValues='NONE'
+        )
+
+    def save_result(self, challenge_id, success, lock, attributes=None):
+        update_expression = ['#success = :success']
+        expression_attribute_names = {
+            '#success': 'success',
+            '#lock': 'verifyLock'
+        }
+        expression_attribute_values = {
+            ':success': success,
+            ':lock': lock
+        }
+        for name, value in (attributes or dict()).items():
+            update_expression.append('#{0} = :{0}'.format(name))
+            expression_attribute_names['#{}'.format(name)] = name
+            expression_attribute_values[':{}'.format(name)] = _write_item(value)
+        try:
+            self.table.update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set {} remove #lock'.format(', '.join(update_expression)),
+                ConditionExpression='#lock = :lock',
+                ExpressionAttributeNames=expression_attribute_names,
+                ExpressionAttributeValues=expression_attribute_values,
+                ReturnValues='NONE'
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise error
+        return True
+
+
+class S3FrameStore(FrameStore):
+    inline_detection_image = False
+
+    def __init__(self, bucket_name, account_id=None, region_name=None, config=None):
+        self.bucket_name = bucket_name
+        self.account_id = account_id
+        self.s3 = boto3.client('s3', region_name=region_name, config=config)
+
+    def put_frame(self, key, body):
+        self.s3.put_object(
+            Body=body,
+            Bucket=self.bucket_name,
+            Key=key,
+            ExpectedBucketOwner=self.account_id  # Bucket Sniping prevention
+        )
+
+    def get_frame(self, key, offset=None, length=None):
+        params = dict()
+        if offset is not None:
+            params['Range'] = 'bytes={}-{}'.format(offset, offset + length - 1)
+        return self.s3.get_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            ExpectedBucketOwner=self.account_id,  # Bucket Sniping prevention
+            **params
+        )['Body'].read()
+
+    def get_detection_image(self, key):
+        return {
+            'S3Object': {
+                'Bucket': self.bucket_name,
+                'Name': key
+            }
+        }
+
+
+# Challenge store keeping whole challenges as documents, updated with an atomic read-modify-write
+class _DocumentChallengeStore(ChallengeStore):
+
+    @abstractmethod
+    def _update(self, challenge_id, func, create=False):
+        # Applies func to a copy of the challenge (a new one if missing and create is True) and saves it if func
+        # returns True
+        pass
+
+    def append_frames(self, challenge_id, frames, create=False):
+        def append(challenge):
+            challenge.setdefault('frames', []).extend(copy.deepcopy(frames))
+            return True
+
+        return self._update(challenge_id, append, create) is not None
+
+    def acquire_verify_lock(self, challenge_id, lock, now):
+        def acquire(challenge):
+            if 'success' in challenge or challenge.get('verifyLock', now - 1) >= now:
+                return False
+            challenge['verifyLock'] = lock
+            return True
+
+        return self._update(challenge_id, acquire)
+
+    def release_verify_lock(self, challenge_id, lock):
+        def release(challenge):
+            if challenge.get('verifyLock') != lock:
+                return False
+            del challenge['verifyLock']
+            return True
+
+        self._update(challenge_id, release)
+
+    def save_frames_metadata(self, challenge_id, frames):
+        def save(challenge):
+            for index, frame in frames.items():
+                if 'rekMetadata' in frame:
+                    challenge['frames'][index]['rekMetadata'] = copy.deepcopy(frame['rekMetadata'])
+            return True
+
+        self._update(challenge_id, save)
+
+    def save_result(self, challenge_id, success, lock, attributes=None):
+        def save(challenge):
+            if challenge.get('verifyLock') != lock:
+                return False
+            del challenge['verifyLock']
+            challenge.update(copy.deepcopy(attributes or dict()))
+            challenge['success'] = success
+            return True
+
+        return self._update(challenge_id, save) is not None
+
+
+class MemoryChallengeStore(_DocumentChallengeStore):
+
+    def __init__(self):
+        self.challenges = dict()
+        self.lock = threading.Lock()
+
+    def put_challenge(self, challenge):
+        with self.lock:
+            self.challenges[challenge['id']] = copy.deepcopy(challenge)
+
+    def get_challenge(self, challenge_id):
+        with self.lock:
+            return copy.deepcopy(self.challenges.get(challenge_id))
+
+    def _update(self, challenge_id, func, create=False):
+        with self.lock:
+            if challenge_id not in self.challenges and not create:
+                return None
+            challenge = copy.deepcopy(self.challenges.get(challenge_id, {'id': challenge_id}))
+            if not func(challenge):
+                return None
+            self.challenges[challenge_id] = challenge
+            return copy.deepcopy(challenge)
+
+
+class MemoryFrameStore(FrameStore):
+
+    def __init__(self):
+        self.frames = dict()
+
+    def put_frame(self, key, body):
+        self.frames[key] = bytes(body)
+
+    def get_frame(self, key, offset=None, length=None):
+        if offset is not None:
+            return self.frames[key][offset:offset + length]
+        return self.frames[key]
+
+
+class SqliteChallengeStore(_DocumentChallengeStore):
+
+    def __init__(self, database):
+        self.database = database
+        with closing(self._connect()) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS challenge (id TEXT PRIMARY KEY, item TEXT NOT NULL)')
+
+    def put_challenge(self, challenge):
+        with closing(self._connect()) as connection:
+            connection.execute('INSERT OR REPLACE INTO challenge (id, item) VALUES (?, ?)',
+                               (challenge['id'], json.dumps(challenge)))
+
+    def get_challenge(self, challenge_id):
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT item FROM challenge WHERE id = ?', (challenge_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _update(self, challenge_id, func, create=False):
+        connection = self._connect()
+        try:
+            # Write lock taken up front, so concurrent read-modify-writes do not interleave
+            connection.execute('BEGIN IMMEDIATE')
+            if create:
+                connection.execute('INSERT OR IGNORE INTO challenge (id, item) VALUES (?, ?)',
+                                   (challenge_id, json.dumps({'id': challenge_id})))
+            row = connection.execute('SELECT item FROM challenge WHERE id = ?', (challenge_id,)).fetchone()
+            if row is None:
+                connection.rollback()
+                return None
+            challenge = json.loads(row[0])
+            if not func(challenge):
+                connection.rollback()
+                return None
+            connection.execute('UPDATE challenge SET item = ? WHERE id = ?', (json.dumps(challenge), challenge_id))
+            connection.commit()
+            return challenge
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=30, isolation_level=None)
+
+
+class FileSystemFrameStore(FrameStore):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put_frame(self, key, body):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(body)
+
+    def get_frame(self, key, offset=None, length=None):
+        with open(self._path(key), 'rb') as file:
+            if offset is None:
+                return file.read()
+            file.seek(offset)
+            return file.read(length)
+
+    def _path(self, key):
+        path = os.path.realpath(os.path.join(self.directory, key))
+        if not path.startswith(os.path.realpath(self.directory) + os.sep):
+            raise ValueError('Invalid frame key: {}'.format(key))
+        return path
+
+
+class DynamoDbLoadStore(LoadStore):
+
+    def __init__(self, table_name, region_name=None, config=None):
+        self.table_name = table_name
+        self.dynamodb = boto3.resource('dynamodb', region_name=region_name, config=config)
+        self.table = self.dynamodb.Table(table_name) if table_name else None
+
+    def add_counters(self, bucket, counters, expires_at):
+        update_expression = []
+        expression_attribute_names = {'#expiresAt': 'expiresAt'}
+        expression_attribute_values = {':expiresAt': expires_at}
+        for index, (name, value) in enumerate(counters.items()):
+            update_expression.append('#c{0} :c{0}'.format(index))
+            expression_attribute_names['#c{}'.format(index)] = name
+            expression_attribute_values[':c{}'.format(index)] = _write_item(value)
+        self.table.update_item(
+            Key={'bucket': bucket},
+            UpdateExpression='add {} set #expiresAt = :expiresAt'.format(', '.join(update_expression)),
+            ExpressionAttributeNames=expression_attribute_names,
+            ExpressionAttributeValues=expression_attribute_values,
+            ReturnValues='NONE'
+        )
+
+    def get_counters(self, buckets):
+        # Unprocessed keys are ignored, load counters are best effort
+        response = self.dynamodb.batch_get_item(
+            RequestItems={self.table_name: {'Keys': [{'bucket': bucket} for bucket in buckets]}}
+        )
+        counters = dict()
+        for item in _read_item(response['Responses'].get(self.table_name, [])):
+            bucket = item.pop('bucket')
+            item.pop('expiresAt', None)
+            counters[bucket] = item
+        return counters
+
+
+class MemoryLoadStore(LoadStore):
+
+    def __init__(self):
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def add_counters(self, bucket, counters, expires_at):
+        with self.lock:
+            bucket_counters = self.buckets.setdefault(bucket, {'expiresAt': expires_at})
+            bucket_counters['expiresAt'] = expires_at
+            for name, value in counters.items():
+                bucket_counters[name] = bucket_counters.get(name, 0) + value
+
+    def get_counters(self, buckets):
+        with self.lock:
+            return {bucket: {name: value for name, value in self.buckets[bucket].items() if name != 'expiresAt'}
+                    for bucket in buckets if bucket in self.buckets}
+
+
+class SqliteLoadStore(LoadStore):
+
+    def __init__(self, database):
+        self.database = database
+        with closing(self._connect()) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS load (bucket INTEGER NOT NULL, name TEXT NOT NULL, '
+                               'value REAL NOT NULL, expires_at INTEGER NOT NULL, PRIMARY KEY (bucket, name))')
+
+    def add_counters(self, bucket, counters, expires_at):
+        with closing(self._connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            # Buckets are identified by their start time, so this removes buckets expired before the current one
+            connection.execute('DELETE FROM load WHERE expires_at < ?', (bucket,))
+            for name, value in counters.items():
+                connection.execute('INSERT INTO load (bucket, name, value, expires_at) VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT (bucket, name) DO UPDATE SET value = value + excluded.value',
+                                   (bucket, name, value, expires_at))
+            connection.commit()
+
+    def get_counters(self, buckets):
+        buckets = list(buckets)
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT bucket, name, value FROM load WHERE bucket IN ({})'.format(
+                ', '.join('?' * len(buckets))), buckets).fetchall()
+        counters = dict()
+        for bucket, name, value in rows:
+            counters.setdefault(bucket, dict())[name] = value
+        return counters
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=30, isolation_level=None)
+
+
+def _read_item(item):
+    return json.loads(json.dumps(item, cls=_DecimalEncoder))
+
+
+def _write_item(item):
+    return json.loads(json.dumps(item), parse_float=decimal.Decimal)
+
+
+# Helper class to convert a DynamoDB item to JSON.
+class _DecimalEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            if o % 1 > 0:
+                return float(o)
+            return int(o)
+        return super(_DecimalEncoder, self).default(o)
@@ -0,0 +1,47 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+from chalice.test import Client
+
+# Backend configuration (read when the backend modules are imported)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STORAGE_BACKEND', 'MEMORY')
+
+
+# Rekognition client returning no faces (or failing when error is set)
+class FakeRekognition:
+
+    def __init__(self):
+        self.images = []
+        self.error = None
+
+    def detect_faces(self, Attributes, Image):
+        self.images.append(Image)
+        if self.error is not None:
+            raise ClientError({'Error': {'Code': self.error, 'Message': self.error}}, 'DetectFaces')
+        return {'FaceDetails': []}
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    # Backend (registered on the app) with empty in-memory stores, a fake Rekognition client and a token secret
+    import app  # noqa: F401
+    from chalicelib import framework
+    from chalicelib.storage import MemoryChallengeStore, MemoryFrameStore
+    monkeypatch.setattr(framework, '_challenge_store', MemoryChallengeStore())
+    monkeypatch.setattr(framework, '_frame_store', MemoryFrameStore())
+    monkeypatch.setattr(framework, '_rek', FakeRekognition())
+    monkeypatch.setattr(framework._jwt_manager, 'secret', 'liveness-detection-test-token-secret')
+    return framework
+
+
+@pytest.fixture
+def client(backend):
+    from app import app
+    with Client(app) as client:
+        yield client
+
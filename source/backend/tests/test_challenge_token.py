@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import base64
+import io
+import json
+import time
+
+import jwt
+import pytest
+from PIL import Image
+
+from chalicelib.jwt_manager import JwtManager
+
+
+@pytest.fixture
+def jwt_manager():
+    jwt_manager = JwtManager(None, 600)
+    jwt_manager.secret = 'liveness-detection-test-token-secret'
+    return jwt_manager
+
+
+@pytest.fixture
+def stateless_backend(backend, monkeypatch):
+    monkeypatch.setattr(backend, '_STATELESS_CHALLENGES', True)
+    return backend
+
+
+def _request(client, method, path, body):
+    return client.http.request(method, path, headers={'Content-Type': 'application/json'}, body=json.dumps(body))
+
+
+def _put_frame(client, challenge_id, token):
+    output = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(output, 'JPEG')
+    return _request(client, 'PUT', '/challenge/{}/frame'.format(challenge_id), {
+        'token': token,
+        'timestamp': 1000,
+        'frameBase64': base64.b64encode(output.getvalue()).decode()
+    })
+
+
+def _verify(client, challenge_id, token):
+    return _request(client, 'POST', '/challenge/{}/verify'.format(challenge_id), {'token': token})
+
+
+def test_get_challenge(jwt_manager):
+    token = jwt_manager.get_jwt_token('challenge-id', 'POSE', {'imageWidth': 640})
+    challenge = jwt_manager.get_challenge(token)
+    assert challenge['id'] == 'challenge-id'
+    assert challenge['type'] == 'POSE'
+    assert challenge['params'] == {'imageWidth': 640}
+    assert time.time() - 5 < challenge['issuedAt'] <= time.time()
+    assert jwt.decode(token, options={'verify_signature': False})['exp'] == challenge['issuedAt'] + 600
+
+
+def test_get_challenge_without_challenge(jwt_manager):
+    assert jwt_manager.get_challenge(jwt_manager.get_jwt_token('challenge-id')) == {'id': 'challenge-id'}
+
+
+def test_get_challenge_expired(jwt_manager):
+    jwt_manager.challenge_max_age = -1
+    token = jwt_manager.get_jwt_token('challenge-id', 'POSE', {'imageWidth': 640})
+    with pytest.raises(jwt.ExpiredSignatureError):
+        jwt_manager.get_challenge(token)
+
+
+def test_get_challenge_invalid_signature(jwt_manager):
+    token = jwt_manager.get_jwt_token('challenge-id', 'POSE', {'imageWidth': 640})
+    jwt_manager.secret = 'another-liveness-detection-token-secret'
+    with pytest.raises(jwt.InvalidSignatureError):
+        jwt_manager.get_challenge(token)
+
+
+def test_stateless_challenge(client, stateless_backend):
+    challenge = _request(client, 'POST', '/challenge', {'imageWidth': 64, 'imageHeight': 48}).json_body
+    # Challenge is only saved when its first frame is received
+    assert stateless_backend._challenge_store.get_challenge(challenge['id']) is None
+    assert _put_frame(client, challenge['id'], challenge['token']).status_code == 200
+    assert _verify(client, challenge['id'], challenge['token']).status_code == 200
+    saved = stateless_backend._challenge_store.get_challenge(challenge['id'])
+    assert saved['type'] == challenge['type']
+    assert saved['params'] == challenge['params']
+    assert 'issuedAt' in saved and 'success' in saved
+
+
+def test_stateless_token_without_challenge(client, stateless_backend):
+    token = stateless_backend._jwt_manager.get_jwt_token('challenge-id')
+    assert _put_frame(client, 'challenge-id', token).status_code == 401
+    assert _verify(client, 'challenge-id', token).status_code == 401
+    assert stateless_backend._challenge_store.get_challenge('challenge-id') is None
+
+
+def test_stateless_expired_token(client, stateless_backend, monkeypatch):
+    monkeypatch.setattr(stateless_backend._jwt_manager, 'challenge_max_age', -1)
+    token = stateless_backend._jwt_manager.get_jwt_token('challenge-id', 'POSE', {'imageWidth': 64})
+    assert _put_frame(client, 'challenge-id', token).status_code == 401
+    assert _verify(client, 'challenge-id', token).status_code == 401
+    assert stateless_backend._challenge_store.get_challenge('challenge-id') is None
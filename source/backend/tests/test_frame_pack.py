@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import base64
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+CHALLENGE_ID = 'challenge-id'
+
+
+@pytest.fixture
+def packed_backend(backend, monkeypatch):
+    monkeypatch.setattr(backend, '_FRAME_STORE_MODE', backend.FRAME_STORE_PACKED)
+    backend._challenge_store.put_challenge({'id': CHALLENGE_ID, 'type': 'NOSE',
+                                            'params': {'imageWidth': 64, 'imageHeight': 48}})
+    return backend
+
+
+def _jpeg(color):
+    output = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(output, 'JPEG')
+    return output.getvalue()
+
+
+def _put_frames(client, backend, frames):
+    body = {
+        'token': backend._jwt_manager.get_jwt_token(CHALLENGE_ID),
+        'frames': [{'timestamp': timestamp, 'frameBase64': base64.b64encode(frame).decode()}
+                   for timestamp, frame in frames]
+    }
+    return client.http.put('/challenge/{}/frame'.format(CHALLENGE_ID),
+                            headers={'Content-Type': 'application/json'}, body=json.dumps(body))
+
+
+def test_build_frame_pack(backend):
+    frames = [(1, b'first'), (2, b'second'), (3, b'third')]
+    frame_items = [{'key': '{}/{}.jpg'.format(CHALLENGE_ID, timestamp)} for timestamp, _ in frames]
+    pack_key, pack = backend._build_frame_pack(CHALLENGE_ID, frames, frame_items)
+    assert pack_key.startswith('{}/1-'.format(CHALLENGE_ID)) and pack_key.endswith('.pack')
+    assert pack == b'firstsecondthird'
+    assert [frame_item['pack'] for frame_item in frame_items] == [
+        {'key': pack_key, 'offset': 0, 'length': 5},
+        {'key': pack_key, 'offset': 5, 'length': 6},
+        {'key': pack_key, 'offset': 11, 'length': 5}
+    ]
+    # Pack keys are unique, so a later batch starting at the same timestamp does not overwrite this pack
+    assert backend._build_frame_pack(CHALLENGE_ID, frames, [dict(), dict(), dict()])[0] != pack_key
+
+
+def test_load_packed_frames(backend):
+    backend._frame_store.put_frame('a/1.pack', b'0123456789')
+    backend._frame_store.put_frame('a/2.pack', b'abcdef')
+    frames = {
+        0: {'key': 'a/0.jpg'},
+        2: {'key': 'a/2.jpg', 'pack': {'key': 'a/1.pack', 'offset': 2, 'length': 3}},
+        3: {'key': 'a/3.jpg', 'pack': {'key': 'a/1.pack', 'offset': 7, 'length': 2}},
+        5: {'key': 'a/5.jpg', 'pack': {'key': 'a/2.pack', 'offset': 0, 'length': 4}}
+    }
+    with ThreadPoolExecutor() as pool:
+        images = backend._load_packed_frames(pool, frames)
+    # Frames stored as single objects are not loaded
+    assert images == {2: b'234', 3: b'78', 5: b'abcd'}
+    assert backend._read_frame_pack([frames[3], frames[2]]) == [b'78', b'234']
+
+
+def test_put_frames_packed(client, packed_backend):
+    frames = [(1000, _jpeg('red')), (1100, _jpeg('green')), (1200, _jpeg('blue'))]
+    assert _put_frames(client, packed_backend, frames).status_code == 200
+    frame_items = packed_backend._challenge_store.get_challenge(CHALLENGE_ID)['frames']
+    assert [frame_item['key'] for frame_item in frame_items] == ['{}/{}.jpg'.format(CHALLENGE_ID, timestamp)
+                                                                 for timestamp, _ in frames]
+    assert len({frame_item['pack']['key'] for frame_item in frame_items}) == 1
+    assert len(packed_backend._frame_store.frames) == 1
+    # Stored frame keys resolve through their pack
+    assert [packed_backend.get_challenge_frame(frame_item) for frame_item in frame_items] == [frame for _, frame in
+                                                                                              frames]
+
+
+def test_get_challenge_frame_object(backend):
+    backend._frame_store.put_frame('a/1.jpg', b'frame')
+    assert backend.get_challenge_frame({'key': 'a/1.jpg', 'timestamp': 1}) == b'frame'
+
+
+def test_verify_packed_frames(client, packed_backend):
+    frames = [(1000, _jpeg('red')), (1100, _jpeg('green'))]
+    _put_frames(client, packed_backend, frames[:1])
+    _put_frames(client, packed_backend, frames[1:])
+    response = client.http.post('/challenge/{}/verify'.format(CHALLENGE_ID),
+                                headers={'Content-Type': 'application/json'},
+                                body=json.dumps({'token': packed_backend._jwt_manager.get_jwt_token(CHALLENGE_ID)}))
+    assert response.json_body == {'success': False}
+    assert sorted(image['Bytes'] for image in packed_backend._rek.images) == sorted(frame for _, frame in frames)
@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from chalicelib.frame_quality import best_frames, get_frame_quality
+
+
+def _jpeg(image):
+    output = io.BytesIO()
+    image.save(output, 'JPEG')
+    return output.getvalue()
+
+
+def _frame(key, sharpness, brightness=120, size=1000):
+    return {'key': key, 'quality': {'sharpness': sharpness, 'brightness': brightness, 'size': size}}
+
+
+def test_get_frame_quality():
+    image = Image.fromarray((np.random.default_rng(0).random((480, 640)) * 255).astype('uint8'))
+    sharp = get_frame_quality(_jpeg(image))
+    blurry = get_frame_quality(_jpeg(image.filter(ImageFilter.GaussianBlur(5))))
+    assert sharp['sharpness'] > blurry['sharpness']
+    assert 100 < sharp['brightness'] < 150
+
+
+def test_best_frames():
+    frames = [_frame('a/1.jpg', 10), _frame('a/2.jpg', 50), _frame('a/3.jpg', 30), _frame('a/4.jpg', 40)]
+    # Best frames are kept in their original order
+    assert [frame['key'] for frame in best_frames(frames, 2)] == ['a/2.jpg', 'a/4.jpg']
+    assert best_frames(frames, 1)[0] is frames[1]
+    assert best_frames(frames, 10) == frames
+
+
+def test_best_frames_prefers_well_exposed():
+    frames = [_frame('a/1.jpg', 100, brightness=10), _frame('a/2.jpg', 20), _frame('a/3.jpg', 200, brightness=250)]
+    assert [frame['key'] for frame in best_frames(frames, 1)] == ['a/2.jpg']
+
+
+def test_best_frames_without_quality():
+    frames = [{'key': 'a/1.jpg'}, _frame('a/2.jpg', 1)]
+    assert [frame['key'] for frame in best_frames(frames, 1)] == ['a/2.jpg']
+
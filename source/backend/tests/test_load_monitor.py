@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+
+import pytest
+
+from chalicelib.load_monitor import LoadMonitor, choose_challenge_type, publish_decision_metrics
+from chalicelib.storage import MemoryLoadStore
+
+CHALLENGE_TYPES = ['POSE', 'NOSE']
+
+
+def _metrics(in_flight_verifies=0, throttle_rate=0.0):
+    return {
+        'inFlightVerifies': in_flight_verifies,
+        'throttleRate': throttle_rate,
+        'challengeTypes': {
+            'POSE': {'verifies': 10, 'detections': 1, 'latency': 0.5},
+            'NOSE': {'verifies': 10, 'detections': 30, 'latency': 5.0}
+        }
+    }
+
+
+def test_choose_challenge_type_without_pressure():
+    challenge_type, decision = choose_challenge_type(CHALLENGE_TYPES, _metrics(), 0.2, 10, 2.0)
+    assert challenge_type in CHALLENGE_TYPES
+    assert decision['pressure'] == 0
+    assert decision['shares'] == {'POSE': 0.5, 'NOSE': 0.5}
+
+
+def test_choose_challenge_type_without_observations():
+    metrics = {'inFlightVerifies': 10, 'throttleRate': 0.0, 'challengeTypes': {}}
+    _, decision = choose_challenge_type(CHALLENGE_TYPES, metrics, 0.2, 10, 2.0)
+    assert decision['shares'] == {'POSE': 0.5, 'NOSE': 0.5}
+
+
+@pytest.mark.parametrize('metrics', [_metrics(in_flight_verifies=10), _metrics(throttle_rate=1.0)])
+def test_choose_challenge_type_sheds_load(metrics):
+    _, decision = choose_challenge_type(CHALLENGE_TYPES, metrics, 0.2, 10, 2.0)
+    assert decision['pressure'] == 1
+    assert decision['shares']['POSE'] > 0.75
+    # Minimum share kept for security
+    assert decision['shares']['NOSE'] >= 0.2
+    assert sum(decision['shares'].values()) == pytest.approx(1)
+
+
+def test_choose_challenge_type_partial_pressure():
+    _, partial = choose_challenge_type(CHALLENGE_TYPES, _metrics(in_flight_verifies=3), 0.2, 10, 2.0)
+    _, full = choose_challenge_type(CHALLENGE_TYPES, _metrics(in_flight_verifies=30), 0.2, 10, 2.0)
+    assert 0.5 < partial['shares']['POSE'] < full['shares']['POSE']
+
+
+def test_publish_decision_metrics(capsys):
+    _, decision = choose_challenge_type(CHALLENGE_TYPES, _metrics(in_flight_verifies=5), 0.2, 10, 2.0)
+    publish_decision_metrics(decision)
+    # One metric set (in the embedded metric format) per line
+    metric_sets = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    values = dict()
+    for metric_set in metric_sets:
+        assert metric_set['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'LivenessDetection'
+        name = metric_set['_aws']['CloudWatchMetrics'][0]['Metrics'][0]['Name']
+        values[(name, metric_set.get('ChallengeType'))] = metric_set[name][0]
+    assert values[('LoadPressure', None)] == 50
+    assert values[('InFlightVerifies', None)] == 5
+    assert values[('ChallengeTypeShare', 'POSE')] == pytest.approx(100 * decision['shares']['POSE'])
+    assert values[('ChallengeTypeSelected', decision['challengeType'])] == 1
+    assert len(metric_sets) == 8
+
+
+def test_load_monitor_metrics():
+    monitor = LoadMonitor(MemoryLoadStore(), cache_seconds=0)
+    monitor.verify_started()
+    monitor.verify_started()
+    monitor.verify_finished('POSE', 0.5, 1, 0)
+    monitor.verify_started()
+    monitor.verify_finished('NOSE', 4.0, 20, 5)
+    metrics = monitor.get_metrics()
+    assert metrics['inFlightVerifies'] == 1
+    assert metrics['throttleRate'] == pytest.approx(5 / 21, rel=0.05)
+    assert metrics['challengeTypes']['POSE']['detections'] == pytest.approx(1)
+    assert metrics['challengeTypes']['NOSE']['detections'] == pytest.approx(20)
+    assert metrics['challengeTypes']['NOSE']['latency'] == pytest.approx(4.0)
+
+
+def test_load_monitor_decay():
+    load_store = MemoryLoadStore()
+    monitor = LoadMonitor(load_store, bucket_seconds=10, window_buckets=30, half_life_seconds=60, cache_seconds=0)
+    load_store.add_counters(1000, {'detections': 10, 'throttled': 10}, 1310)
+    recent = monitor.get_metrics(now=1005)
+    later = monitor.get_metrics(now=1125)
+    expired = monitor.get_metrics(now=1400)
+    assert recent['throttleRate'] == pytest.approx(1)
+    assert later['throttleRate'] == pytest.approx(0.25)
+    assert expired['throttleRate'] == 0
+
+
+def test_load_monitor_ignores_store_errors():
+    class FailingLoadStore(MemoryLoadStore):
+        def add_counters(self, bucket, counters, expires_at):
+            raise RuntimeError()
+
+        def get_counters(self, buckets):
+            raise RuntimeError()
+
+    monitor = LoadMonitor(FailingLoadStore(), cache_seconds=0)
+    monitor.verify_started()
+    assert monitor.get_metrics() == {'inFlightVerifies': 0, 'throttleRate': 0.0, 'challengeTypes': {}}
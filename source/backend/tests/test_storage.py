@@ -0,0 +1,174 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+from chalicelib.storage import DynamoDbChallengeStore, MemoryChallengeStore, MemoryFrameStore, MemoryLoadStore, SqliteChallengeStore, \
+    FileSystemFrameStore, SqliteLoadStore
+
+CHALLENGE_ID = 'challenge-id'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def challenge_store(request, tmp_path):
+    if request.param == 'memory':
+        store = MemoryChallengeStore()
+    else:
+        store = SqliteChallengeStore(str(tmp_path / 'liveness.db'))
+    store.put_challenge({'id': CHALLENGE_ID, 'type': 'POSE', 'params': {'imageWidth': 640}})
+    return store
+
+
+@pytest.fixture(params=['memory', 'filesystem'])
+def frame_store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryFrameStore()
+    return FileSystemFrameStore(str(tmp_path / 'frames'))
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def load_store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryLoadStore()
+    return SqliteLoadStore(str(tmp_path / 'liveness.db'))
+
+
+def test_get_challenge(challenge_store):
+    assert challenge_store.get_challenge(CHALLENGE_ID) == {'id': CHALLENGE_ID, 'type': 'POSE',
+                                                           'params': {'imageWidth': 640}}
+    assert challenge_store.get_challenge('unknown') is None
+
+
+def test_append_frames(challenge_store):
+    assert challenge_store.append_frames(CHALLENGE_ID, [{'key': 'a/1.jpg', 'timestamp': 1}])
+    assert challenge_store.append_frames(CHALLENGE_ID, [{'key': 'a/2.jpg', 'timestamp': 2},
+                                                        {'key': 'a/3.jpg', 'timestamp': 3}])
+    frames = challenge_store.get_challenge(CHALLENGE_ID)['frames']
+    assert [frame['key'] for frame in frames] == ['a/1.jpg', 'a/2.jpg', 'a/3.jpg']
+
+
+def test_append_frames_unknown_challenge(challenge_store):
+    assert not challenge_store.append_frames('unknown', [{'key': 'b/1.jpg', 'timestamp': 1}])
+    assert challenge_store.get_challenge('unknown') is None
+
+
+def test_append_frames_create(challenge_store):
+    assert challenge_store.append_frames('new', [{'key': 'b/1.jpg', 'timestamp': 1}], create=True)
+    assert challenge_store.append_frames('new', [{'key': 'b/2.jpg', 'timestamp': 2}], create=True)
+    challenge = challenge_store.get_challenge('new')
+    assert challenge['id'] == 'new'
+    assert [frame['key'] for frame in challenge['frames']] == ['b/1.jpg', 'b/2.jpg']
+
+
+def test_acquire_verify_lock(challenge_store):
+    challenge = challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100)
+    assert challenge['verifyLock'] == 160
+    assert challenge['type'] == 'POSE'
+    # Lock held (not expired yet)
+    assert challenge_store.acquire_verify_lock(CHALLENGE_ID, 220, 159) is None
+
+
+def test_acquire_verify_lock_expired(challenge_store):
+    assert challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100) is not None
+    challenge = challenge_store.acquire_verify_lock(CHALLENGE_ID, 221, 161)
+    assert challenge['verifyLock'] == 221
+
+
+def test_acquire_verify_lock_unknown_challenge(challenge_store):
+    assert challenge_store.acquire_verify_lock('unknown', 160, 100) is None
+
+
+def test_release_verify_lock(challenge_store):
+    challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100)
+    challenge_store.release_verify_lock(CHALLENGE_ID, 160)
+    assert 'verifyLock' not in challenge_store.get_challenge(CHALLENGE_ID)
+    assert challenge_store.acquire_verify_lock(CHALLENGE_ID, 170, 110) is not None
+
+
+def test_release_verify_lock_of_another_request(challenge_store):
+    challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100)
+    challenge_store.release_verify_lock(CHALLENGE_ID, 150)
+    assert challenge_store.get_challenge(CHALLENGE_ID)['verifyLock'] == 160
+
+
+def test_save_frames_metadata(challenge_store):
+    challenge_store.append_frames(CHALLENGE_ID, [{'key': 'a/1.jpg'}, {'key': 'a/2.jpg'}])
+    challenge_store.save_frames_metadata(CHALLENGE_ID, {1: {'key': 'a/2.jpg', 'rekMetadata': [{'Confidence': 99.5}]}})
+    frames = challenge_store.get_challenge(CHALLENGE_ID)['frames']
+    assert 'rekMetadata' not in frames[0]
+    assert frames[1]['rekMetadata'] == [{'Confidence': 99.5}]
+
+
+def test_save_frames_metadata_many_frames(challenge_store):
+    challenge_store.append_frames(CHALLENGE_ID, [{'key': 'a/{}.jpg'.format(index)} for index in range(120)])
+    challenge_store.save_frames_metadata(CHALLENGE_ID, {index: {'key': 'a/{}.jpg'.format(index),
+                                                                'rekMetadata': [{'Confidence': index}]}
+                                                        for index in range(120)})
+    frames = challenge_store.get_challenge(CHALLENGE_ID)['frames']
+    assert [frame['rekMetadata'] for frame in frames] == [[{'Confidence': index}] for index in range(120)]
+
+
+def test_dynamodb_save_frames_metadata_many_frames():
+    class Table:
+        def __init__(self):
+            self.updates = []
+
+        def update_item(self, **kwargs):
+            self.updates.append(kwargs)
+
+    store = DynamoDbChallengeStore(None)
+    store.table = Table()
+    store.save_frames_metadata(CHALLENGE_ID, {index: {'key': 'a/{}.jpg'.format(index),
+                                                      'rekMetadata': [{'Confidence': index}]}
+                                              for index in range(500)})
+    # Each update expression stays under the 4 KB DynamoDB limit, and every frame is saved once
+    assert len(store.table.updates) > 1
+    assert all(len(update['UpdateExpression']) <= 4096 for update in store.table.updates)
+    values = [value for update in store.table.updates for value in update['ExpressionAttributeValues']]
+    assert sorted(values) == sorted(':rekMetadata{}'.format(index) for index in range(500))
+
+
+def test_save_result(challenge_store):
+    challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100)
+    assert challenge_store.save_result(CHALLENGE_ID, True, 160, {'issuedAt': 90})
+    challenge = challenge_store.get_challenge(CHALLENGE_ID)
+    assert challenge['success'] is True
+    assert challenge['issuedAt'] == 90
+    assert 'verifyLock' not in challenge
+    # Verified challenges are not locked again
+    assert challenge_store.acquire_verify_lock(CHALLENGE_ID, 300, 200) is None
+
+
+def test_save_result_after_losing_lock(challenge_store):
+    challenge_store.acquire_verify_lock(CHALLENGE_ID, 160, 100)
+    challenge_store.acquire_verify_lock(CHALLENGE_ID, 221, 161)
+    assert not challenge_store.save_result(CHALLENGE_ID, False, 160)
+    challenge = challenge_store.get_challenge(CHALLENGE_ID)
+    assert 'success' not in challenge
+    assert challenge['verifyLock'] == 221
+    assert challenge_store.save_result(CHALLENGE_ID, True, 221)
+    assert challenge_store.get_challenge(CHALLENGE_ID)['success'] is True
+
+
+def test_frame_store(frame_store):
+    frame_store.put_frame('a/1.pack', b'0123456789')
+    assert frame_store.get_frame('a/1.pack') == b'0123456789'
+    assert frame_store.get_frame('a/1.pack', 2, 3) == b'234'
+    assert frame_store.inline_detection_image
+    assert frame_store.get_detection_image('a/1.pack') == {'Bytes': b'0123456789'}
+
+
+def test_file_system_frame_store_invalid_key(tmp_path):
+    frame_store = FileSystemFrameStore(str(tmp_path / 'frames'))
+    with pytest.raises(ValueError):
+        frame_store.put_frame('../outside.jpg', b'')
+
+
+def test_load_store(load_store):
+    load_store.add_counters(100, {'started': 1}, 400)
+    load_store.add_counters(100, {'started': 1, 'finished': 1}, 400)
+    load_store.add_counters(110, {'detections': 3}, 410)
+    assert load_store.get_counters([100, 110, 120]) == {
+        100: {'started': 2, 'finished': 1},
+        110: {'detections': 3}
+    }
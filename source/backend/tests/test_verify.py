@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import time
+
+CHALLENGE_ID = 'challenge-id'
+
+
+def _verify(client, backend, challenge_id=CHALLENGE_ID):
+    body = {'token': backend._jwt_manager.get_jwt_token(challenge_id)}
+    return client.http.post('/challenge/{}/verify'.format(challenge_id),
+                            headers={'Content-Type': 'application/json'}, body=json.dumps(body))
+
+
+def _put_challenge(backend, frames, **attributes):
+    challenge = {'id': CHALLENGE_ID, 'type': 'NOSE', 'params': {'imageWidth': 640, 'imageHeight': 480},
+                 'frames': frames}
+    challenge.update(attributes)
+    backend._challenge_store.put_challenge(challenge)
+    for frame in frames:
+        backend._frame_store.put_frame(frame['key'], 'frame {}'.format(frame['timestamp']).encode())
+
+
+def _frames(count, analyzed=0):
+    frames = [{'key': '{}/{}.jpg'.format(CHALLENGE_ID, index), 'timestamp': index} for index in range(count)]
+    for frame in frames[:analyzed]:
+        frame['rekMetadata'] = []
+    return frames
+
+
+def test_verify(client, backend):
+    _put_challenge(backend, _frames(3))
+    response = _verify(client, backend)
+    assert response.status_code == 200
+    assert response.json_body == {'success': False}
+    challenge = backend._challenge_store.get_challenge(CHALLENGE_ID)
+    assert challenge['success'] is False
+    assert 'verifyLock' not in challenge
+    assert all('rekMetadata' in frame for frame in challenge['frames'])
+    assert len(backend._rek.images) == 3
+
+
+def test_verify_returns_stored_result(client, backend):
+    _put_challenge(backend, _frames(3), success=True)
+    response = _verify(client, backend)
+    assert response.status_code == 200
+    assert response.json_body == {'success': True}
+    assert backend._rek.images == []
+
+
+def test_verify_unknown_challenge(client, backend):
+    assert _verify(client, backend, 'unknown').status_code == 404
+
+
+def test_verify_analyzes_only_pending_frames(client, backend):
+    _put_challenge(backend, _frames(3, analyzed=2))
+    assert _verify(client, backend).json_body == {'success': False}
+    assert backend._rek.images == [{'Bytes': b'frame 2'}]
+    frames = backend._challenge_store.get_challenge(CHALLENGE_ID)['frames']
+    assert all('rekMetadata' in frame for frame in frames)
+
+
+def test_verify_in_progress(client, backend, monkeypatch):
+    monkeypatch.setattr(backend, '_VERIFY_WAIT_TIMEOUT', 0.05)
+    monkeypatch.setattr(backend, '_VERIFY_WAIT_INTERVAL', 0.01)
+    _put_challenge(backend, _frames(3), verifyLock=int(time.time()) + 60)
+    assert _verify(client, backend).status_code == 409
+    assert backend._rek.images == []
+
+
+def test_verify_after_lock_expired(client, backend):
+    _put_challenge(backend, _frames(3), verifyLock=int(time.time()) - 1)
+    assert _verify(client, backend).json_body == {'success': False}
+
+
+def test_verify_failure_releases_lock(client, backend):
+    backend._rek.error = 'ThrottlingException'
+    _put_challenge(backend, _frames(3))
+    assert _verify(client, backend).status_code == 500
+    assert 'verifyLock' not in backend._challenge_store.get_challenge(CHALLENGE_ID)
+    # Retry is not blocked by the failed verify
+    backend._rek.error = None
+    assert _verify(client, backend).json_body == {'success': False}